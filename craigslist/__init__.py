@@ -1,7 +1,11 @@
 from .craigslist import (
     CraigslistCommunity, CraigslistEvents, CraigslistForSale, CraigslistGigs,
     CraigslistHousing, CraigslistJobs, CraigslistResumes, CraigslistServices)
+from .checkpoint import Checkpoint
+from .geotags import GeotagProvider
+from .images import ImageDownloader
 
 __all__ = [
     'CraigslistCommunity', 'CraigslistEvents', 'CraigslistForSale', 'CraigslistGigs',
-    'CraigslistHousing', 'CraigslistJobs', 'CraigslistResumes', 'CraigslistServices']
+    'CraigslistHousing', 'CraigslistJobs', 'CraigslistResumes', 'CraigslistServices',
+    'Checkpoint', 'GeotagProvider', 'ImageDownloader']
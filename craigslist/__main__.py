@@ -0,0 +1,334 @@
+"""
+Runs many saved searches on a shared worker pool and streams new results as
+JSON lines.
+
+    python -m craigslist searches.json [--workers N] [--output FILE] [--once]
+
+The config file is a JSON list of searches, or an object with a `searches`
+list and optional `workers`, `rate_limit` (seconds between requests to the
+same host) and `host_rate_limits` ({host: seconds}) keys. A search needs a
+`class` (one of the Craigslist* wrappers), and looks like:
+
+    {"name": "sf-rooms", "class": "CraigslistHousing", "site": "sfbay",
+     "area": "sfc", "category": "roo", "filters": {"max_price": 1200},
+     "interval": 600, "priority": 1, "limit": 100}
+
+Searches can also set `geotagged`, `include_details`, and `predicate` /
+`detail_predicate` filter specs (see `utils.make_predicate`).
+
+Searches are polled in order of their next due time (higher `priority` wins
+ties), and each poll only yields postings not seen by previous polls. Every
+poll logs its latency and result counts, plus the search's totals so far.
+"""
+import argparse
+from collections import deque
+import heapq
+import itertools
+import json
+import logging
+import sys
+from threading import Condition, Lock, Thread
+import time
+
+from . import craigslist as wrappers
+from . import utils
+from .base import CraigslistBase
+
+DEFAULT_INTERVAL = 600  # Seconds between two polls of the same search
+DEFAULT_LIMIT = 100  # Max results per poll
+DEFAULT_WORKERS = 4
+DEFAULT_RATE_LIMIT = 1.0  # Seconds between two requests to the same host
+SEEN_IDS_PER_SEARCH = 10000  # How many posting ids to remember per search
+SEEN_RUN_TO_STOP = 20  # Consecutive seen postings that end a poll
+
+logger = logging.getLogger('python-craiglist.runner')
+
+
+class _StopPoll(Exception):
+    """ Stops a poll once the rest of the postings were processed before. """
+
+
+class SavedSearch(object):
+    """ A search from the config file, plus its polling state. """
+
+    def __init__(self, config, log_level=logging.WARNING):
+        self.name = config.get('name') or '%s:%s:%s:%s' % (
+            config.get('class'), config.get('site'), config.get('area'),
+            config.get('category'))
+        class_name = config.get('class')
+        wrapper_class = getattr(wrappers, class_name or '', None)
+        if not (isinstance(wrapper_class, type) and
+                issubclass(wrapper_class, CraigslistBase) and
+                wrapper_class is not CraigslistBase):
+            raise ValueError("'%s' is not a valid class (search '%s')"
+                             % (class_name, self.name))
+        self.wrapper_class = wrapper_class
+        self.site = config.get('site')
+        self.area = config.get('area')
+        self.category = config.get('category')
+        self.filters = config.get('filters') or {}
+        self.interval = float(config.get('interval', DEFAULT_INTERVAL))
+        self.priority = int(config.get('priority', 0))
+        self.limit = config.get('limit', DEFAULT_LIMIT)
+        self.geotagged = bool(config.get('geotagged', False))
+        self.include_details = bool(config.get('include_details', False))
+        self.predicate = utils.make_predicate(config.get('predicate'))
+        self.detail_predicate = config.get('detail_predicate')
+        self.log_level = log_level
+
+        self.wrapper = None  # Created lazily, it makes network requests.
+        self.seen = set()
+        self.seen_order = deque()
+        # Newest posting time of the last poll that processed every new
+        # posting (i.e. wasn't cut short by `limit`).
+        self.watermark = None
+        self.caught_up = True  # Whether the last poll wasn't cut short
+        self.polls = 0
+        self.total_results = 0
+        self.total_time = 0.0
+
+    def stats(self):
+        avg = self.total_time / self.polls if self.polls else 0
+        return '%s polls, %s results, avg latency %.2fs' % (
+            self.polls, self.total_results, avg)
+
+    def mark_seen(self, id):
+        self.seen.add(id)
+        self.seen_order.append(id)
+        if len(self.seen_order) > SEEN_IDS_PER_SEARCH:
+            self.seen.discard(self.seen_order.popleft())
+
+    def poll(self):
+        """
+        Returns the postings that were not returned by a previous poll.
+
+        Results are requested newest first, and postings seen before are
+        skipped without fetching their details. The poll stops at the first
+        posting older than `watermark`, or after `SEEN_RUN_TO_STOP` seen
+        postings in a row. Up to `limit` new postings are processed per poll;
+        if there were more, the watermark isn't moved, so the next poll gets
+        to the rest.
+        """
+
+        if self.wrapper is None:
+            wrapper = self.wrapper_class(
+                site=self.site, area=self.area, category=self.category,
+                filters=dict(self.filters), log_level=self.log_level)
+            # Every wrapper adds a handler to the shared logger, the runner
+            # already has one.
+            wrapper.logger.removeHandler(wrapper.handler)
+            self.wrapper = wrapper
+
+        processed_ids = []
+        state = {'seen_run': 0, 'newest': None, 'complete': True}
+
+        def predicate(result):
+            posted = result['last_updated']
+            if posted and self.watermark and posted < self.watermark:
+                raise _StopPoll()
+            if posted and (state['newest'] is None or
+                           posted > state['newest']):
+                state['newest'] = posted
+            if result['id'] in self.seen:
+                # The run only ends a poll if the previous one was complete,
+                # otherwise the postings it left are after the seen ones.
+                state['seen_run'] += 1
+                if self.caught_up and state['seen_run'] >= SEEN_RUN_TO_STOP:
+                    raise _StopPoll()
+                return False
+            state['seen_run'] = 0
+            if self.limit is not None and len(processed_ids) >= self.limit:
+                state['complete'] = False
+                raise _StopPoll()
+            processed_ids.append(result['id'])
+            return self.predicate is None or self.predicate(result)
+
+        new_results = []
+        try:
+            for result in self.wrapper.get_results(
+                    sort_by='newest', geotagged=self.geotagged,
+                    include_details=self.include_details,
+                    predicate=predicate,
+                    detail_predicate=self.detail_predicate):
+                new_results.append(result)
+        except _StopPoll:
+            pass
+        # Rejected postings are marked too, so they aren't processed again.
+        for id in processed_ids:
+            self.mark_seen(id)
+        # The first poll counts as complete even if cut short, so older
+        # postings (already there before the runner started) are left out.
+        self.caught_up = state['complete'] or self.watermark is None
+        if state['newest'] and self.caught_up:
+            self.watermark = max(state['newest'], self.watermark or '')
+        return new_results
+
+
+class Runner(object):
+    """
+    Polls saved searches on `workers` threads. Searches wait in a heap keyed
+    by their next due time, so each free worker always picks the most overdue
+    search and a slow search only ever occupies one worker.
+    """
+
+    def __init__(self, searches, output, workers=DEFAULT_WORKERS, once=False):
+        self.output = output
+        self.workers = workers
+        self.once = once
+        self._output_lock = Lock()
+        self._cond = Condition()
+        self._heap = []
+        self._running = 0
+        self._stopping = False
+        self._counter = itertools.count()  # Tie-breaker for the heap
+        now = time.time()
+        for search in searches:
+            self._schedule(search, now)
+
+    def _schedule(self, search, due):
+        heapq.heappush(
+            self._heap, (due, -search.priority, next(self._counter), search))
+
+    def _next_search(self):
+        """ Blocks until a search is due. Returns None when done. """
+
+        with self._cond:
+            while True:
+                if self._stopping:
+                    return None
+                if not self._heap:
+                    if self.once and not self._running:
+                        self._cond.notify_all()
+                        return None
+                    self._cond.wait()
+                    continue
+                wait = self._heap[0][0] - time.time()
+                if wait <= 0:
+                    search = heapq.heappop(self._heap)[3]
+                    self._running += 1
+                    return search
+                self._cond.wait(wait)
+
+    def _done(self, search):
+        with self._cond:
+            self._running -= 1
+            if not self.once:
+                self._schedule(search, time.time() + search.interval)
+            self._cond.notify_all()
+
+    def _write(self, search, results):
+        with self._output_lock:
+            for result in results:
+                record = dict(result, search=search.name)
+                self.output.write(json.dumps(record) + '\n')
+            self.output.flush()
+
+    def _worker(self):
+        while True:
+            search = self._next_search()
+            if search is None:
+                return
+            started = time.time()
+            succeeded = False
+            try:
+                results = search.poll()
+                succeeded = True
+            except Exception as exc:
+                logger.error("Search '%s' failed (%s)", search.name, exc)
+                results = []
+            elapsed = time.time() - started
+            if succeeded:
+                search.polls += 1
+                search.total_results += len(results)
+                search.total_time += elapsed
+                self._write(search, results)
+            logger.info("Search '%s': %s new results in %.2fs (%s)",
+                        search.name, len(results), elapsed,
+                        search.stats())
+            self._done(search)
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def run(self):
+        threads = []
+        for _ in range(self.workers):
+            thread = Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            # Join with a timeout so KeyboardInterrupt is still delivered.
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def report(self, searches):
+        for search in searches:
+            logger.info("Search '%s': %s", search.name, search.stats())
+
+
+def load_config(path):
+    with open(path, 'r') as f:
+        config = json.load(f)
+    if isinstance(config, list):
+        config = {'searches': config}
+    return config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m craigslist',
+        description='Polls saved Craigslist searches and streams new '
+                    'results as JSON lines.')
+    parser.add_argument('config', help='JSON file with the saved searches')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of worker threads (default: %s)'
+                             % DEFAULT_WORKERS)
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSONL file to append results to '
+                             '(default: stdout)')
+    parser.add_argument('--once', action='store_true',
+                        help='poll every search once and exit')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='logging level (default: WARNING); '
+                             'per-search stats are logged unless it is '
+                             'above WARNING')
+    args = parser.parse_args(argv)
+
+    log_level = getattr(logging, args.log_level.upper())
+    # A single handler for the runner and all the wrappers' logs.
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    base_logger = logging.getLogger('python-craiglist')
+    base_logger.addHandler(handler)
+    base_logger.setLevel(log_level)
+    # The runner's stats are logged by default, only a level above WARNING
+    # hides them.
+    logger.setLevel(log_level if log_level > logging.WARNING
+                    else min(log_level, logging.INFO))
+
+    config = load_config(args.config)
+    searches = [SavedSearch(search, log_level=log_level)
+                for search in config['searches']]
+    utils.rate_limiter = utils.RateLimiter(
+        float(config.get('rate_limit', DEFAULT_RATE_LIMIT)),
+        per_host=config.get('host_rate_limits'))
+    workers = args.workers or config.get('workers', DEFAULT_WORKERS)
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'a')
+    try:
+        runner = Runner(searches, output, workers=workers, once=args.once)
+        runner.run()
+        runner.report(searches)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,28 @@
 import logging
+import math
 try:
     from Queue import Queue  # PY2
 except ImportError:
     from queue import Queue  # PY3
 from threading import Thread
+from timeit import default_timer as timer
 try:
     from urlparse import urljoin  # PY2
 except ImportError:
     from urllib.parse import urljoin  # PY3
 
+from requests.exceptions import RequestException, Timeout
 from six import iteritems
 from six.moves import range
 
 from . import utils
+from .checkpoint import Checkpoint
+from .geotags import GeotagProvider
 
 ALL_SITES = utils.get_all_sites()  # All the Craiglist sites
 RESULTS_PER_REQUEST = 100  # Craigslist returns 100 results per request
+# With a deadline, every request gets at least this share of the time left.
+MIN_REQUEST_TIMEOUT = 2  # Seconds
 
 
 class CraigslistBase(object):
@@ -45,6 +52,10 @@ class CraigslistBase(object):
     # Set to True to subclass defines the customize_results() method
     custom_result_fields = False
 
+    # Gets geotags in bulk when get_results is called with geotagged=True.
+    # Shared by all instances, so its cache is too.
+    geotag_provider = GeotagProvider()
+
     sort_by_options = {
         'newest': 'date',
         'price_asc': 'priceasc',
@@ -55,6 +66,8 @@ class CraigslistBase(object):
                  log_level=logging.WARNING):
         # Logging
         self.set_logger(log_level, init=True)
+        # Latencies of detail fetches, used to decide when to hedge them.
+        self.detail_latency = utils.LatencyTracker()
 
         self.site = site or self.default_site
         if self.site not in ALL_SITES:
@@ -126,9 +139,9 @@ class CraigslistBase(object):
 
     def is_valid_area(self, area):
         base_url = self.url_templates['base']
-        response = utils.requests_get(base_url % {'site': self.site},
-                                      logger=self.logger)
-        soup = utils.bs(response.content)
+        soup = self.fetch_content(base_url % {'site': self.site})
+        if soup is None:
+            return False
         sublinks = soup.find('ul', {'class': 'sublinks'})
         return sublinks and sublinks.find('a', text=area) is not None
 
@@ -154,12 +167,42 @@ class CraigslistBase(object):
         return int(totalcount.text) if totalcount else None
 
     def get_results(self, limit=None, start=0, sort_by=None, geotagged=False,
-                    include_details=False):
+                    include_details=False, checkpoint=None, predicate=None,
+                    detail_predicate=None, deadline=None,
+                    hedge_percentile=None, bulk_geotags=True):
         """
         Gets results from Craigslist based on the specified filters.
 
         If geotagged=True, the results will include the (lat, lng) in the
         'geotag' attrib (this will make the process a little bit longer).
+        Unless include_details=True (which fetches every posting's page
+        anyway), geotags are taken from the map view of the search (one
+        request for all results, see `geotag_provider`), and only postings
+        missing from it have their page fetched. Set bulk_geotags=False to
+        always fetch the page of every posting.
+
+        If checkpoint is given (a path or a `Checkpoint`), the progress is
+        saved there, and a later call with the same checkpoint resumes from
+        where it stopped (with the same filters and sort), skipping results
+        already yielded.
+
+        predicate and detail_predicate filter results client-side, either as
+        a function that takes a result and returns a bool, or as a dict spec
+        (see `utils.make_predicate`). predicate is checked on the fields from
+        the results list, before fetching any details, so rejected postings
+        cost no extra request. detail_predicate is checked once details are
+        added.
+
+        If deadline is given (in seconds), no request is made once it has
+        passed, and the time left is split among the listing and detail
+        requests. Results whose details couldn't be fetched in time are still
+        yielded (without checking detail_predicate), with 'details_skipped'
+        set to True. With a checkpoint, a resumed crawl fetches their details
+        and yields them again. Other request errors are raised as usual.
+
+        If hedge_percentile is given (e.g. 95), a detail request that takes
+        longer than that percentile of the previous ones is sent again, and
+        the first response is used.
         """
 
         if sort_by:
@@ -171,14 +214,86 @@ class CraigslistBase(object):
                 self.logger.error(msg)
                 raise ValueError(msg)
 
-        total_so_far = start
+        predicate = utils.make_predicate(predicate)
+        detail_predicate = utils.make_predicate(detail_predicate)
+
         results_yielded = 0
+        if checkpoint is not None:
+            if not isinstance(checkpoint, Checkpoint):
+                checkpoint = Checkpoint(checkpoint)
+            if checkpoint.started:
+                if checkpoint.url != self.url:
+                    msg = ("Checkpoint '%s' belongs to a different search "
+                           "(%s)" % (checkpoint.path, checkpoint.url))
+                    self.logger.error(msg)
+                    raise ValueError(msg)
+                self.logger.info('Resuming from checkpoint at %s results',
+                                 checkpoint.results_yielded)
+                self.filters = dict(checkpoint.filters)
+                start = checkpoint.start
+                results_yielded = checkpoint.results_yielded
+            else:
+                checkpoint.begin(self.url, self.filters, start)
+
+        deadline = utils.deadline_in(deadline)
+
+        if checkpoint is not None and checkpoint.skipped:
+            # Results yielded without details in a previous run.
+            skipped = list(checkpoint.skipped.values())
+            for index, result in enumerate(skipped):
+                if limit is not None and results_yielded >= limit:
+                    break
+                fetch_deadline = None
+                if deadline is not None:
+                    fetch_deadline = self.request_deadline(
+                        deadline, len(skipped) - index)
+                result = self.enrich_result(
+                    dict(result, details_skipped=False), geotagged,
+                    include_details, deadline=fetch_deadline)
+                if result['details_skipped']:
+                    continue  # Still no time, left for the next run.
+                if detail_predicate is not None and not detail_predicate(
+                        result):
+                    checkpoint.mark_rejected(result['id'])
+                    continue
+                yield result
+                checkpoint.mark_yielded(result['id'])
+                results_yielded += 1
+
+        if checkpoint is not None and checkpoint.finished:
+            checkpoint.save()
+            return
+
+        total_so_far = start
         total = 0
+        geotags = None
+        # To split the time left until the deadline: rows left after the
+        # current page (None until the first page is fetched), and how many
+        # rows passed `predicate` and needed their page fetched so far.
+        rows_after_page = None
+        rows_seen = rows_passed = rows_fetched = 0
 
         while True:
             self.filters['s'] = start
-            response = utils.requests_get(self.url, params=self.filters,
-                                          logger=self.logger)
+            listing_deadline = deadline
+            if deadline is not None and rows_after_page is not None:
+                results_left = (None if limit is None
+                                else limit - results_yielded)
+                listing_deadline = self.request_deadline(
+                    deadline, self.estimate_requests_left(
+                        0, rows_after_page, rows_seen, rows_passed,
+                        rows_fetched, results_left))
+            try:
+                response = utils.requests_get(self.url, params=self.filters,
+                                              logger=self.logger,
+                                              deadline=listing_deadline)
+            except RequestException as exc:
+                if not self.out_of_time(exc, deadline):
+                    raise
+                self.logger.warning('Stopping before the deadline (%s)', exc)
+                if checkpoint is not None:
+                    checkpoint.save()
+                return
             self.logger.info('GET %s', response.url)
             self.logger.info('Response code: %s', response.status_code)
             response.raise_for_status()  # Something failed?
@@ -188,25 +303,99 @@ class CraigslistBase(object):
                 total = self.get_results_approx_count(soup=soup)
 
             rows = soup.find('ul', {'class': 'rows'})
-            for row in rows.find_all('li', {'class': 'result-row'},
-                                     recursive=False):
+            rows = rows.find_all('li', {'class': 'result-row'},
+                                 recursive=False)
+            if len(rows) < RESULTS_PER_REQUEST:
+                rows_after_page = 0  # Last page
+            elif total:
+                rows_after_page = max(total - start - len(rows), 0)
+            else:
+                rows_after_page = RESULTS_PER_REQUEST  # Assume one more
+            for index, row in enumerate(rows):
                 if limit is not None and results_yielded >= limit:
                     break
-                self.logger.debug('Processing %s of %s results ...',
-                                  total_so_far + 1, total or '(undefined)')
+                total_so_far += 1
 
-                yield self.process_row(row, geotagged, include_details)
+                if (checkpoint is not None and
+                        checkpoint.is_done(row.attrs['data-pid'])):
+                    continue  # Processed (and its details fetched) before.
+
+                self.logger.debug('Processing %s of %s results ...',
+                                  total_so_far, total or '(undefined)')
+
+                result = self.parse_row(row)
+                rows_seen += 1
+                if predicate is not None and not predicate(result):
+                    continue
+                rows_passed += 1
+                if (geotagged and bulk_geotags and not include_details and
+                        geotags is None):
+                    geotags = self.geotag_provider.get_geotags(
+                        self.url, self.filters, deadline=deadline)
+                fetch_deadline = hedge_delay = None
+                if include_details or (geotagged and not (
+                        geotags and result['id'] in geotags)):
+                    rows_fetched += 1
+                    if deadline is not None:
+                        results_left = (None if limit is None
+                                        else limit - results_yielded - 1)
+                        # This request, plus the ones estimated after it.
+                        requests_left = 1 + self.estimate_requests_left(
+                            len(rows) - index - 1, rows_after_page,
+                            rows_seen, rows_passed, rows_fetched,
+                            results_left)
+                        fetch_deadline = self.request_deadline(
+                            deadline, requests_left)
+                if hedge_percentile is not None:
+                    hedge_delay = self.detail_latency.percentile(
+                        hedge_percentile)
+                result = self.enrich_result(
+                    result, geotagged, include_details,
+                    deadline=fetch_deadline, hedge_delay=hedge_delay,
+                    geotags=geotags)
+                if result['details_skipped']:
+                    # Yielded as is, but not done: a resumed crawl will
+                    # fetch its details.
+                    if checkpoint is not None:
+                        checkpoint.mark_skipped(result)
+                    yield result
+                    results_yielded += 1
+                    continue
+                if detail_predicate is not None and not detail_predicate(
+                        result):
+                    if checkpoint is not None:
+                        checkpoint.mark_rejected(result['id'])
+                    continue
+                yield result
+                if checkpoint is not None:
+                    checkpoint.mark_yielded(result['id'])
 
                 results_yielded += 1
-                total_so_far += 1
 
             if results_yielded == limit:
                 break
             if (total_so_far - start) < RESULTS_PER_REQUEST:
                 break
+            if deadline is not None and utils.time_left(deadline) <= 0:
+                # Not finished, so a checkpoint can still be resumed.
+                self.logger.warning('Stopping, deadline exceeded')
+                if checkpoint is not None:
+                    checkpoint.save()
+                return
             start = total_so_far
+            if checkpoint is not None:
+                checkpoint.set_cursor(start)
+
+        if checkpoint is not None:
+            checkpoint.finish()
 
     def process_row(self, row, geotagged=False, include_details=False):
+        result = self.parse_row(row)
+        return self.enrich_result(result, geotagged, include_details)
+
+    def parse_row(self, row):
+        """ Builds a result from the fields available in the results list. """
+
         id = row.attrs['data-pid']
         repost_of = row.attrs.get('data-repost-of')
 
@@ -245,10 +434,87 @@ class CraigslistBase(object):
                   # field will be marked as True. If you want to be extra
                   # careful, always check this field is False before using a
                   # result.
-                  'deleted': False}
+                  'deleted': False,
+                  # Set to True if a deadline was given to get_results and
+                  # the details (or geotag) couldn't be fetched in time.
+                  'details_skipped': False}
+
+        return result
+
+    @staticmethod
+    def estimate_requests_left(rows_on_page, rows_after_page, rows_seen,
+                               rows_passed, rows_fetched, results_left=None):
+        """
+        Estimates how many requests are left to get the remaining results:
+        one detail request per row expected to pass `predicate` and need its
+        page (at the rates seen so far, `rows_passed / rows_seen` and
+        `rows_fetched / rows_passed`), and one listing request per page left.
+        `results_left` (if there's a limit) caps the rows expected to pass.
+        """
+
+        pass_rate = float(rows_passed) / rows_seen if rows_seen else 1.0
+        fetch_rate = float(rows_fetched) / rows_passed if rows_passed else 1.0
+        results_on_page = rows_on_page * pass_rate
+        results_after_page = rows_after_page * pass_rate
+        if results_left is not None:
+            results_on_page = min(results_on_page, results_left)
+            results_after_page = min(results_after_page,
+                                     results_left - results_on_page)
+            if pass_rate:
+                rows_after_page = results_after_page / pass_rate
+        pages_left = int(math.ceil(
+            float(rows_after_page) / RESULTS_PER_REQUEST))
+        return (results_on_page + results_after_page) * fetch_rate + pages_left
+
+    @staticmethod
+    def request_deadline(deadline, requests_left):
+        """
+        Splits the time left until `deadline` evenly among `requests_left`
+        requests, and returns the deadline for the next one.
+        """
+
+        time_left = utils.time_left(deadline)
+        share = max(time_left / max(requests_left, 1),
+                    min(time_left, MIN_REQUEST_TIMEOUT))
+        return utils.deadline_in(share)
+
+    @staticmethod
+    def out_of_time(exc, deadline):
+        """
+        Whether a failed request (`exc`) is due to `deadline` (i.e. it timed
+        out, or the deadline has passed), rather than an actual error.
+        """
+
+        return deadline is not None and (
+            isinstance(exc, Timeout) or utils.time_left(deadline) <= 0)
+
+    def enrich_result(self, result, geotagged=False, include_details=False,
+                      deadline=None, hedge_delay=None, geotags=None):
+        """
+        Adds the fields that require fetching the posting's page. If the
+        page can't be fetched before `deadline`, the result is returned
+        without them and with 'details_skipped' set to True.
+
+        If the posting is in `geotags` ({id: (lat, lng)}), its geotag is
+        taken from there instead of its page.
+        """
+
+        if geotagged and geotags and result['id'] in geotags:
+            result['geotag'] = geotags[result['id']]
+            geotagged = False  # No need to fetch the page for it.
 
         if geotagged or include_details:
-            detail_soup = self.fetch_content(result['url'])
+            try:
+                detail_soup = self.fetch_content(
+                    result['url'], deadline=deadline, hedge_delay=hedge_delay,
+                    latency=self.detail_latency)
+            except RequestException as exc:
+                if not self.out_of_time(exc, deadline):
+                    raise
+                self.logger.debug('Skipping details of %s (%s)',
+                                  result['url'], exc)
+                detail_soup = None
+                result['details_skipped'] = True
             if detail_soup:
                 if geotagged:
                     self.geotag_result(result, detail_soup)
@@ -363,12 +629,58 @@ class CraigslistBase(object):
                     result[key] = option
                     break
 
-    def fetch_content(self, url):
-        response = utils.requests_get(url, logger=self.logger)
+    def fetch_content(self, url, deadline=None, hedge_delay=None,
+                      latency=None):
+        """
+        Returns the parsed content of `url`, or None if the response is not
+        OK. Raises RequestException if the request fails (e.g. it times out
+        or can't connect, even after a retry).
+
+        Concurrent calls for the same url share a single request (and the
+        same parsed soup, which should not be modified), unless it times out
+        because of a tighter deadline than the caller's.
+
+        See `utils.requests_get` for `deadline`. If `hedge_delay` is given and
+        there's no response after that many seconds, a request of this
+        caller's own is sent too (see `utils.hedged_call`). If `latency` (a
+        `utils.LatencyTracker`) is given, successful requests are added to it.
+        """
+
+        def shared():
+            return utils.single_flight.do_with_deadline(
+                utils.canonical_url(url), deadline, self._fetch_content, url,
+                latency=latency)
+
+        def own():
+            return self._fetch_content(url, deadline=deadline,
+                                       latency=latency)
+
+        return utils.hedged_call(shared, own, hedge_delay, logger=self.logger)
+
+    def fetch_content_async(self, url):
+        """
+        Awaitable version of `fetch_content`, to be used from asyncio code.
+        The request runs in the event loop's default executor. Concurrent
+        calls for the same url within the event loop share a single request.
+        """
+
+        import asyncio  # PY3 only
+
+        loop = asyncio.get_event_loop()
+        return utils.single_flight.do_async(
+            utils.canonical_url(url),
+            lambda: loop.run_in_executor(None, self._fetch_content, url))
+
+    def _fetch_content(self, url, deadline=None, latency=None):
+        started = timer()
+        response = utils.requests_get(url, logger=self.logger,
+                                      deadline=deadline)
         self.logger.info('GET %s', response.url)
         self.logger.info('Response code: %s', response.status_code)
 
         if response.ok:
+            if latency is not None:
+                latency.add(timer() - started)
             return utils.bs(response.content)
 
         self.logger.warning("GET %s returned not OK response code: %s "
@@ -407,7 +719,10 @@ class CraigslistBase(object):
     @classmethod
     def get_list_filters(cls, url):
         if cls.__list_filters.get(url) is None:
-            cls.__list_filters[url] = utils.get_list_filters(url)
+            # Threads hitting a cold cache share a single request.
+            cls.__list_filters[url] = utils.single_flight.do(
+                ('list_filters', utils.canonical_url(url)),
+                utils.get_list_filters, url)
         return cls.__list_filters[url]
 
     @classmethod
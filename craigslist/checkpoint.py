@@ -0,0 +1,106 @@
+import json
+import os
+
+from . import utils
+
+
+class Checkpoint(object):
+    """
+    Progress of a `get_results` call, persisted to `path` so that an
+    interrupted crawl can be resumed.
+
+    It stores the search url and filters (including sort and the pagination
+    cursor `s`), the ids of the results already yielded and the ids of the
+    results rejected by `detail_predicate` (so their detail pages aren't
+    fetched again). Results yielded without details because of a deadline
+    are kept apart, to fetch their details when the crawl is resumed.
+
+    It is saved every `save_every` results, at the end of each page and when
+    the crawl ends. A result is only marked as yielded once the consumer asks
+    for the next one, so an interrupted crawl may yield again the results
+    after the last save, but never skips one.
+    """
+
+    def __init__(self, path, save_every=25):
+        self.path = path
+        self.save_every = save_every
+        self.url = None
+        self.filters = None
+        self.start = 0
+        self.results_yielded = 0
+        self.finished = False
+        self.yielded_ids = set()
+        self.rejected_ids = set()
+        self.skipped = {}  # id -> result yielded without its details
+        self._unsaved = 0
+
+        if os.path.exists(path):
+            self.load()
+
+    @property
+    def started(self):
+        return self.url is not None
+
+    def load(self):
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        self.url = data['url']
+        self.filters = data['filters']
+        self.start = data['start']
+        self.results_yielded = data['results_yielded']
+        self.finished = data['finished']
+        self.yielded_ids = set(data['yielded_ids'])
+        self.rejected_ids = set(data.get('rejected_ids', []))
+        self.skipped = data.get('skipped', {})
+
+    def save(self):
+        utils.atomic_write_json(self.path, {
+            'url': self.url,
+            'filters': self.filters,
+            'start': self.start,
+            'results_yielded': self.results_yielded,
+            'finished': self.finished,
+            'yielded_ids': sorted(self.yielded_ids),
+            'rejected_ids': sorted(self.rejected_ids),
+            'skipped': self.skipped,
+        })
+        self._unsaved = 0
+
+    def begin(self, url, filters, start):
+        self.url = url
+        self.filters = dict(filters)
+        self.start = start
+        self.save()
+
+    def set_cursor(self, start):
+        self.start = start
+        self.filters['s'] = start
+        self.save()
+
+    def is_done(self, id):
+        return (id in self.yielded_ids or id in self.rejected_ids or
+                id in self.skipped)
+
+    def mark_yielded(self, id):
+        self.yielded_ids.add(id)
+        self.skipped.pop(id, None)
+        self.results_yielded += 1
+        self._mark_done()
+
+    def mark_rejected(self, id):
+        self.rejected_ids.add(id)
+        self.skipped.pop(id, None)
+        self._mark_done()
+
+    def mark_skipped(self, result):
+        self.skipped[result['id']] = dict(result)
+        self._mark_done()
+
+    def _mark_done(self):
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def finish(self):
+        self.finished = True
+        self.save()
@@ -0,0 +1,101 @@
+import logging
+from threading import Lock
+import time
+try:
+    from urlparse import urljoin  # PY2
+except ImportError:
+    from urllib.parse import urljoin  # PY3
+
+from requests.exceptions import RequestException
+from six import iteritems, string_types
+
+from . import utils
+
+MAX_CLUSTER_DEPTH = 2  # How many levels of map clusters to expand
+
+
+class GeotagProvider(object):
+    """
+    Gets the (lat, lng) of all the postings of a search at once, from the
+    JSON endpoint behind Craigslist's map view, instead of fetching the page
+    of every posting.
+
+    Responses are cached for `ttl` seconds per (url, filters). The endpoint
+    groups nearby postings in clusters, which are expanded with extra
+    requests. Postings missing from the response must be geotagged from
+    their page (`get_results` does so).
+
+    Pass `url` to always fetch the JSON from that url (e.g. a local server
+    serving a recorded response).
+    """
+
+    def __init__(self, url=None, ttl=300, logger=None):
+        self.url = url
+        self.ttl = ttl
+        self.logger = logger or logging.getLogger('python-craiglist')
+        self._cache = {}  # key -> (fetched at, {id: (lat, lng)})
+        self._lock = Lock()
+
+    @staticmethod
+    def search_url(url):
+        """ Returns the map (JSON) version of a search results url. """
+        return url.replace('/search/', '/jsonsearch/', 1)
+
+    def get_geotags(self, url, filters=None, deadline=None):
+        """
+        Returns {posting id: (lat, lng)} for the search at `url` (a search
+        results url) with `filters`. Returns an empty dict if the request
+        fails (which isn't cached), so callers fall back to the posting pages.
+        """
+
+        json_url = self.url or self.search_url(url)
+        params = dict((key, value) for key, value in iteritems(filters or {})
+                      if key != 's')  # All pages are in a single response.
+        key = utils.canonical_url(json_url, params)
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached and time.time() - cached[0] < self.ttl:
+            return cached[1]
+
+        try:
+            geotags = utils.single_flight.do_with_deadline(
+                ('geotags', key), deadline, self._fetch, json_url, params)
+        except (RequestException, ValueError) as exc:
+            self.logger.warning('Could not get geotags from %s (%s)',
+                                json_url, exc)
+            return {}
+        with self._lock:
+            self._cache[key] = (time.time(), geotags)
+        return geotags
+
+    def _fetch(self, url, params=None, depth=0, deadline=None):
+        response = utils.requests_get(url, params=params, logger=self.logger,
+                                      deadline=deadline)
+        self.logger.info('GET %s', response.url)
+        self.logger.info('Response code: %s', response.status_code)
+        response.raise_for_status()
+        data = response.json()
+
+        # The response is [[posting or cluster, ...], {summary}], although
+        # a plain list of postings is accepted too.
+        if not isinstance(data, list):
+            raise ValueError('Unexpected response: %.100r' % data)
+        if data and isinstance(data[0], list):
+            data = data[0]
+
+        geotags = {}
+        for item in data:
+            if not isinstance(item, dict):
+                continue
+            if 'PostingID' in item:
+                try:
+                    geotags[str(item['PostingID'])] = (
+                        float(item['Latitude']), float(item['Longitude']))
+                except (KeyError, TypeError, ValueError):
+                    continue  # No (valid) coordinates for this posting.
+            elif (isinstance(item.get('url'), string_types) and
+                    depth < MAX_CLUSTER_DEPTH):
+                geotags.update(self._fetch(urljoin(url, item['url']),
+                                           deadline=deadline,
+                                           depth=depth + 1))
+        return geotags
@@ -0,0 +1,294 @@
+from collections import deque
+from contextlib import closing
+import hashlib
+import json
+import logging
+import os
+try:
+    from Queue import Empty, Queue  # PY2
+except ImportError:
+    from queue import Empty, Queue  # PY3
+import re
+from threading import Event, Lock, Thread
+try:
+    from urlparse import urlparse  # PY2
+except ImportError:
+    from urllib.parse import urlparse  # PY3
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+from . import utils
+
+# Size variants served by Craigslist for every image.
+IMAGE_SIZES = {
+    'thumbnail': '50x50c',
+    'medium': '300x300',
+    'large': '600x450',  # Same as the urls added by `include_details`
+    'full': '1200x900',
+}
+INDEX_FILENAME = 'index.json'  # Maps image urls to downloaded files
+CHUNK_SIZE = 64 * 1024
+
+
+class _ResultJob(object):
+    """ Tracks the downloads of the images of a single result. """
+
+    def __init__(self, result, urls):
+        self.result = result
+        self.urls = urls
+        self.filenames = {}
+        self.pending = len(set(urls))
+        self.lock = Lock()
+        self.event = Event()
+        if not self.pending:
+            self.event.set()
+
+    def done(self, url, filename):
+        with self.lock:
+            self.filenames[url] = filename
+            self.pending -= 1
+            if not self.pending:
+                self.event.set()
+
+    def finish(self):
+        self.event.wait()
+        self.result['image_files'] = [self.filenames.get(url)
+                                      for url in self.urls]
+        return self.result
+
+
+class ImageDownloader(object):
+    """
+    Downloads the images of results returned with `include_details=True`.
+
+    Images are stored in `directory` named after the SHA-1 of their content,
+    so an image shared by several postings (e.g. reposts) is stored once. The
+    url -> file mapping is kept in `index.json`, so urls are only downloaded
+    once, even across runs. Interrupted downloads are resumed from their
+    `.part` file when possible.
+
+    Use it on live results:
+
+        downloader = ImageDownloader('images/', size='full')
+        for result in downloader.download_results(
+                cl.get_results(include_details=True)):
+            print(result['image_files'])
+
+    or on any iterable of stored results with an 'images' field. Worker
+    threads only run while `download_results` does; call `close()` (or use
+    the downloader as a context manager) to release its connections.
+    """
+
+    def __init__(self, directory, size='large', workers=8, skip_existing=True,
+                 save_every=50, logger=None):
+        self.directory = directory
+        self.size = IMAGE_SIZES.get(size, size)
+        self.workers = workers
+        self.skip_existing = skip_existing
+        self.save_every = save_every
+        self.logger = logger or logging.getLogger('python-craiglist')
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index_path = os.path.join(directory, INDEX_FILENAME)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+
+        # A single session, so connections to the image hosts are reused.
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = utils.USER_AGENT
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = Lock()
+        self._in_flight = {}  # url -> Event, set when its download ends
+        self._unsaved = 0
+        self._queue = None
+        self._threads = []
+
+    def sized_url(self, url):
+        """ Rewrites an image url to the configured size variant. """
+        return re.sub(r'_\d+x\d+c?(\.\w+)$', r'_%s\1' % self.size, url)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def download(self, url):
+        """
+        Downloads an image (unless already downloaded) and returns its
+        filename inside `directory`, or None if it couldn't be downloaded.
+        """
+
+        url = self.sized_url(url)
+        with self._lock:
+            filename = self.index.get(url)
+            if (self.skip_existing and filename and
+                    os.path.exists(self.path(filename))):
+                return filename
+            in_flight = self._in_flight.get(url)
+            if in_flight is None:
+                self._in_flight[url] = Event()
+
+        if in_flight is not None:
+            # Another thread is downloading the same url, wait for it.
+            in_flight.wait()
+            return self.index.get(url)
+
+        filename = None
+        try:
+            filename = self._fetch(url)
+        finally:
+            with self._lock:
+                if filename:
+                    self.index[url] = filename
+                    self._unsaved += 1
+                self._in_flight.pop(url).set()
+        if self._unsaved >= self.save_every:
+            self.save_index()
+        return filename
+
+    def _fetch(self, url):
+        partial_path = self.path(
+            '%s.part' % hashlib.sha1(url.encode('utf-8')).hexdigest())
+        digest = hashlib.sha1()
+        headers = {}
+        if os.path.exists(partial_path):
+            # Resume: hash what we already have and ask for the rest.
+            with open(partial_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+            headers['Range'] = 'bytes=%d-' % os.path.getsize(partial_path)
+
+        try:
+            response = self.session.get(url, headers=headers, stream=True,
+                                        timeout=utils.TIMEOUT)
+            with closing(response):
+                if response.status_code == 206:
+                    mode = 'ab'
+                elif response.ok:
+                    mode = 'wb'
+                    digest = hashlib.sha1()  # Server ignored the Range
+                elif response.status_code == 416 and headers:
+                    mode = None
+                else:
+                    self.logger.warning("GET %s returned not OK response "
+                                        "code: %s (skipping)",
+                                        url, response.status_code)
+                    self._remove(partial_path)
+                    return None
+                if mode is not None:
+                    with open(partial_path, mode) as f:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                            digest.update(chunk)
+        except RequestException as exc:
+            self.logger.warning('Downloading %s failed (%s)', url, exc)
+            return None
+
+        if mode is None:
+            # The partial file can't be resumed (e.g. it's already complete),
+            # download the image again from scratch.
+            self._remove(partial_path)
+            return self._fetch(url)
+
+        extension = os.path.splitext(urlparse(url).path)[1] or '.jpg'
+        filename = digest.hexdigest() + extension
+        if os.path.exists(self.path(filename)):
+            os.remove(partial_path)  # Same image under a different url.
+        else:
+            os.rename(partial_path, self.path(filename))
+        self.logger.debug('Downloaded %s to %s', url, filename)
+        return filename
+
+    @staticmethod
+    def _remove(path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def save_index(self):
+        with self._lock:
+            utils.atomic_write_json(self.index_path, self.index)
+            self._unsaved = 0
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            url, job = item
+            try:
+                filename = self.download(url)
+            except Exception as exc:
+                self.logger.warning('Downloading %s failed (%s)', url, exc)
+                filename = None
+            job.done(url, filename)
+
+    def _submit(self, result):
+        if self._queue is None:
+            self._queue = Queue()
+            for _ in range(self.workers):
+                thread = Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        urls = result.get('images') or []
+        job = _ResultJob(result, urls)
+        for url in set(urls):
+            self._queue.put((url, job))
+        return job
+
+    def _stop_workers(self):
+        """ Drops the downloads not started yet and stops the workers. """
+
+        if self._queue is None:
+            return
+        while True:
+            try:
+                url, job = self._queue.get_nowait()
+            except Empty:
+                break
+            job.done(url, None)
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._queue = None
+        self._threads = []
+
+    def close(self):
+        self._stop_workers()
+        self.save_index()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def download_results(self, results, window=None):
+        """
+        Downloads the images of each result and adds their filenames to
+        'image_files' (None for images that failed). Results are yielded in
+        order; up to `window` results (default: 4 * workers) are downloaded
+        concurrently.
+        """
+
+        window = window or 4 * self.workers
+        pending = deque()
+        try:
+            for result in results:
+                pending.append(self._submit(result))
+                while pending and (pending[0].event.is_set() or
+                                   len(pending) > window):
+                    yield pending.popleft().finish()
+            while pending:
+                yield pending.popleft().finish()
+        finally:
+            self._stop_workers()
+            self.save_index()
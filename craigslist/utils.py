@@ -1,10 +1,27 @@
+from collections import deque
+import json
+import os
+try:
+    from Queue import Empty, Queue  # PY2
+except ImportError:
+    from queue import Empty, Queue  # PY3
+from threading import Event, Lock, Thread
+import time
+try:
+    from urllib import urlencode  # PY2
+    from urlparse import parse_qsl, urlparse, urlunparse
+except ImportError:
+    from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse  # PY3
+
 from bs4 import BeautifulSoup
 import requests
-from requests.exceptions import RequestException
+from requests.exceptions import RequestException, Timeout
+from six import iteritems, string_types
 
 ALL_SITES_URL = 'http://www.craigslist.org/about/sites'
 SITE_URL = 'http://%s.craigslist.org'
 USER_AGENT = 'Mozilla/5.0'
+TIMEOUT = 30  # Default timeout for requests (in seconds)
 
 
 def bs(content):
@@ -18,22 +35,366 @@ def isiterable(var):
         return False
 
 
+class RateLimiter(object):
+    """
+    Spaces out requests made to the same host by at least `interval` seconds.
+    `per_host` can override the interval for specific hosts.
+    """
+
+    def __init__(self, interval, per_host=None):
+        self.interval = interval
+        self.per_host = per_host or {}
+        self._next_slot = {}
+        self._lock = Lock()
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        interval = self.per_host.get(host, self.interval)
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot.get(host, 0))
+            self._next_slot[host] = slot + interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Set to a RateLimiter instance to throttle every call to `requests_get`.
+rate_limiter = None
+
+
+def parse_price(price):
+    """ Converts a price like '$1,200' to a number (None if there's none). """
+
+    digits = ''.join(c for c in price or '' if c.isdigit() or c == '.')
+    try:
+        return float(digits)
+    except ValueError:
+        return None
+
+
+def _contains_any(text, words):
+    if isinstance(words, string_types):
+        words = [words]
+    text = (text or '').lower()
+    return any(word.lower() in text for word in words)
+
+
+def make_predicate(spec):
+    """
+    Builds a function that takes a result and returns whether it should be
+    kept. `spec` can already be a function (returned as is), None (no
+    filtering) or a dict where every condition must hold:
+
+    * min_price / max_price: bounds on the price (results without a price
+      are rejected).
+    * where: (list of) substrings, one must be in the 'where' field.
+    * keywords: (list of) words, one must be in the name.
+    * exclude_keywords: (list of) words, none can be in the name.
+    * exclude_reposts: if True, reject reposts.
+    * any other key: the result field must be equal to the value (e.g.
+      `{'has_image': True}` or, with details, `{'dogs_ok': True}`).
+
+    String matching is case-insensitive.
+    """
+
+    if spec is None or callable(spec):
+        return spec
+
+    spec = dict(spec)
+    min_price = spec.pop('min_price', None)
+    max_price = spec.pop('max_price', None)
+    where = spec.pop('where', None)
+    keywords = spec.pop('keywords', None)
+    exclude_keywords = spec.pop('exclude_keywords', None)
+    exclude_reposts = spec.pop('exclude_reposts', False)
+
+    def predicate(result):
+        if min_price is not None or max_price is not None:
+            price = parse_price(result.get('price'))
+            if price is None:
+                return False
+            if min_price is not None and price < min_price:
+                return False
+            if max_price is not None and price > max_price:
+                return False
+        if where and not _contains_any(result.get('where'), where):
+            return False
+        if keywords and not _contains_any(result.get('name'), keywords):
+            return False
+        if exclude_keywords and _contains_any(result.get('name'),
+                                              exclude_keywords):
+            return False
+        if exclude_reposts and result.get('repost_of'):
+            return False
+        return all(result.get(key) == value for key, value in iteritems(spec))
+
+    return predicate
+
+
+def canonical_url(url, params=None):
+    """
+    Normalizes a url and its GET params (scheme and host case, params order,
+    fragment), so identical requests get the same key.
+    """
+
+    parsed = urlparse(url)
+    query = parse_qsl(parsed.query, keep_blank_values=True)
+    for key, value in iteritems(params or {}):
+        values = value if isinstance(value, (list, tuple)) else [value]
+        query.extend((key, str(v)) for v in values)
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(),
+                       parsed.path or '/', '', urlencode(sorted(query)), ''))
+
+
+class _Call(object):
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.event = Event()
+        self.result = None
+        self.exc = None
+
+    def wait(self):
+        self.event.wait()
+        if self.exc is not None:
+            raise self.exc
+        return self.result
+
+
+def _is_later(deadline, other):
+    """ Whether `deadline` is later than `other` (None is no deadline). """
+    return other is not None and (deadline is None or deadline > other)
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: while a call is in flight,
+    other callers with that key wait for it and share its result (or its
+    exception) instead of making their own call.
+
+    `calls` counts every call, and `coalesced` the ones that didn't run
+    because an identical call was already in flight.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = Lock()
+
+    @property
+    def stats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced}
+
+    def _join(self, key, deadline=None):
+        """ Returns the call for `key`, and whether the caller runs it. """
+
+        with self._lock:
+            self.calls += 1
+            call = self._in_flight.get(key)
+            if call is None:
+                call = self._in_flight[key] = _Call(deadline)
+                return call, True
+            self.coalesced += 1
+            return call, False
+
+    def _run(self, key, call, func, args, kwargs):
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as exc:
+            call.exc = exc
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.event.set()
+        return call.result
+
+    def do(self, key, func, *args, **kwargs):
+        """ Calls `func(*args, **kwargs)` unless it's already in flight. """
+
+        call, leader = self._join(key)
+        if leader:
+            return self._run(key, call, func, args, kwargs)
+        return call.wait()
+
+    def do_with_deadline(self, key, deadline, func, *args, **kwargs):
+        """
+        Same as `do`, for a `func` that takes a `deadline` keyword (see
+        `requests_get`). The call runs with the deadline of the caller that
+        made it, so if it times out, callers with a later deadline (or none)
+        don't get the Timeout: they make the call again.
+        """
+
+        kwargs['deadline'] = deadline
+        while True:
+            call, leader = self._join(key, deadline)
+            if leader:
+                return self._run(key, call, func, args, kwargs)
+            try:
+                return call.wait()
+            except Timeout:
+                if not _is_later(deadline, call.deadline):
+                    raise
+                with self._lock:
+                    # It wasn't shared after all, it's made again below.
+                    self.calls -= 1
+                    self.coalesced -= 1
+
+    def do_async(self, key, factory):
+        """
+        asyncio version of `do`: `factory()` must return an awaitable, which
+        is only created if no identical call is in flight in the current event
+        loop. Returns an awaitable with the shared result.
+        """
+
+        import asyncio  # PY3 only
+
+        loop = asyncio.get_event_loop()
+        key = ('async', id(loop), key)
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            if future is None:
+                future = asyncio.ensure_future(factory())
+                self._in_flight[key] = future
+                future.add_done_callback(
+                    lambda _: self._in_flight.pop(key, None))
+            else:
+                self.coalesced += 1
+        # Shielded, so a caller cancelling doesn't cancel the shared call.
+        return asyncio.shield(future)
+
+
+# Shared by every wrapper, so identical concurrent fetches are coalesced.
+single_flight = SingleFlight()
+
+
+def deadline_in(seconds):
+    """ Returns the absolute deadline `seconds` from now (None if None). """
+    return None if seconds is None else time.time() + seconds
+
+
+def time_left(deadline):
+    """ Seconds left until `deadline` (None if there's no deadline). """
+    return None if deadline is None else deadline - time.time()
+
+
+class LatencyTracker(object):
+    """ Keeps the latest request latencies to compute percentiles. """
+
+    def __init__(self, size=200, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self._lock = Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, percent):
+        """ Returns None until there are at least `min_samples` samples. """
+
+        with self._lock:
+            samples = sorted(self.samples)
+        if len(samples) < self.min_samples:
+            return None
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[min(max(index, 0), len(samples) - 1)]
+
+
 def requests_get(*args, **kwargs):
     """
     Retries if a RequestException is raised (could be a connection error or
     a timeout).
+
+    Requests time out after `TIMEOUT` seconds unless a `timeout` is given. If
+    a `deadline` (absolute time, see `deadline_in`) is given, the timeout is
+    reduced to the time left, and no request (or retry) is made once it has
+    passed.
     """
 
     logger = kwargs.pop('logger', None)
+    deadline = kwargs.pop('deadline', None)
     # Set default User-Agent header if not defined.
     kwargs.setdefault('headers', {}).setdefault('User-Agent', USER_AGENT)
+    timeout = kwargs.pop('timeout', TIMEOUT)
+    url = args[0] if args else kwargs.get('url')
 
-    try:
+    def get():
+        remaining = time_left(deadline)
+        if remaining is None:
+            kwargs['timeout'] = timeout
+        elif remaining <= 0:
+            raise Timeout('Deadline exceeded for %s' % url)
+        else:
+            kwargs['timeout'] = min(timeout, remaining)
+        if rate_limiter:
+            rate_limiter.wait(url)
         return requests.get(*args, **kwargs)
+
+    try:
+        return get()
     except RequestException as exc:
+        if deadline is not None and time_left(deadline) <= 0:
+            raise
         if logger:
             logger.warning('Request failed (%s). Retrying ...', exc)
-        return requests.get(*args, **kwargs)
+        return get()
+
+
+def hedged_call(primary, backup, hedge_delay, logger=None):
+    """
+    Returns `primary()`, but if it hasn't returned after `hedge_delay`
+    seconds, also calls `backup()` and returns whichever result arrives
+    first (or raises if both fail). The slower call is left to finish in
+    the background.
+    """
+
+    if hedge_delay is None:
+        return primary()
+
+    results = Queue()
+
+    def start(func):
+        def run():
+            try:
+                results.put((func(), None))
+            except Exception as exc:
+                results.put((None, exc))
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    start(primary)
+    hedged = False
+    try:
+        result, exc = results.get(timeout=hedge_delay)
+    except Empty:
+        if logger:
+            logger.debug('No response after %.2fs, hedging request ...',
+                         hedge_delay)
+        start(backup)
+        hedged = True
+        result, exc = results.get()
+    if exc is not None and hedged:
+        result, exc = results.get()  # The other call may succeed.
+    if exc is not None:
+        raise exc
+    return result
+
+
+def atomic_write_json(path, data):
+    """ Writes `data` as JSON, so `path` never holds a partial write. """
+
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    try:
+        os.replace(tmp_path, path)  # PY3
+    except AttributeError:
+        if os.path.exists(path):
+            os.remove(path)  # PY2 on Windows can't rename over a file.
+        os.rename(tmp_path, path)
 
 
 def get_all_sites():
@@ -0,0 +1,175 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from requests.exceptions import Timeout
+
+# Importing the package fetches the list of Craigslist sites, which isn't
+# needed (nor wanted) here.
+with mock.patch('requests.get') as requests_get:
+    requests_get.return_value.content = b''
+    from craigslist import utils
+    from craigslist.base import CraigslistBase, MIN_REQUEST_TIMEOUT
+
+
+class BudgetTest(unittest.TestCase):
+    """ Splitting the time left until a deadline among requests. """
+
+    def test_estimate_without_limit(self):
+        # Half the rows pass the predicate, and half of those need their
+        # page: 5 rows on this page, 120 after it (in 3 more pages).
+        requests_left = CraigslistBase.estimate_requests_left(
+            10, 240, rows_seen=20, rows_passed=10, rows_fetched=5)
+        self.assertEqual(requests_left, (5 + 120) * 0.5 + 3)
+
+    def test_estimate_before_any_row(self):
+        # Until rows are seen, every row is assumed to need its page.
+        requests_left = CraigslistBase.estimate_requests_left(0, 100, 0, 0, 0)
+        self.assertEqual(requests_left, 100 + 1)
+
+    def test_estimate_with_limit(self):
+        # Only 20 more results are needed: 5 from this page and 15 (30 rows)
+        # from the next one.
+        requests_left = CraigslistBase.estimate_requests_left(
+            10, 240, 20, 10, 5, results_left=20)
+        self.assertEqual(requests_left, 20 * 0.5 + 1)
+
+        # No more pages if this one has enough results.
+        requests_left = CraigslistBase.estimate_requests_left(
+            10, 240, 20, 10, 5, results_left=3)
+        self.assertEqual(requests_left, 3 * 0.5)
+
+    def test_request_deadline_split(self):
+        deadline = utils.deadline_in(60)
+        request_deadline = CraigslistBase.request_deadline(deadline, 10)
+        self.assertAlmostEqual(utils.time_left(request_deadline), 6,
+                               delta=0.1)
+
+    def test_request_deadline_floor(self):
+        # Too many requests left: each one still gets MIN_REQUEST_TIMEOUT.
+        deadline = utils.deadline_in(10)
+        request_deadline = CraigslistBase.request_deadline(deadline, 100)
+        self.assertAlmostEqual(utils.time_left(request_deadline),
+                               MIN_REQUEST_TIMEOUT, delta=0.1)
+
+        # But never more than the time left.
+        deadline = utils.deadline_in(MIN_REQUEST_TIMEOUT / 2.0)
+        request_deadline = CraigslistBase.request_deadline(deadline, 100)
+        self.assertAlmostEqual(request_deadline, deadline, delta=0.01)
+
+
+class HedgedCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()  # Lets the slow call finish.
+
+    def slow(self):
+        self.release.wait()
+        return 'primary'
+
+    def test_hedges_after_percentile(self):
+        latency = utils.LatencyTracker(min_samples=20)
+        for _ in range(19):
+            latency.add(0.05)
+        latency.add(1.0)
+        hedge_delay = latency.percentile(95)
+        self.assertEqual(hedge_delay, 0.05)
+
+        started = time.time()
+        backup_started = []
+
+        def backup():
+            backup_started.append(time.time() - started)
+            return 'backup'
+
+        result = utils.hedged_call(self.slow, backup, hedge_delay)
+        self.assertEqual(result, 'backup')
+        self.assertGreaterEqual(backup_started[0], hedge_delay)
+
+    def test_no_hedge_without_samples(self):
+        latency = utils.LatencyTracker(min_samples=20)
+        latency.add(0.05)
+        self.assertIsNone(latency.percentile(95))
+
+        backup = mock.Mock(return_value='backup')
+        result = utils.hedged_call(lambda: 'primary', backup,
+                                   latency.percentile(95))
+        self.assertEqual(result, 'primary')
+        self.assertFalse(backup.called)
+
+    def test_no_hedge_if_fast(self):
+        backup = mock.Mock(return_value='backup')
+        result = utils.hedged_call(lambda: 'primary', backup, 1.0)
+        self.assertEqual(result, 'primary')
+        self.assertFalse(backup.called)
+
+
+class SingleFlightDeadlineTest(unittest.TestCase):
+    """ The leader times out with its own (tighter) deadline. """
+
+    def setUp(self):
+        self.single_flight = utils.SingleFlight()
+        self.deadlines = []
+        self.leading = threading.Event()
+        self.release = threading.Event()
+
+    def fetch(self, deadline=None):
+        self.deadlines.append(deadline)
+        if len(self.deadlines) == 1:
+            self.leading.set()
+            self.release.wait()
+            raise Timeout('Deadline exceeded')
+        return 'result'
+
+    def call(self, deadline, outcomes):
+        try:
+            outcomes.append(self.single_flight.do_with_deadline(
+                'key', deadline, self.fetch))
+        except Timeout as exc:
+            outcomes.append(exc)
+
+    def run_follower(self, leader_deadline, follower_deadline):
+        leader_outcomes, follower_outcomes = [], []
+        leader = threading.Thread(target=self.call,
+                                  args=(leader_deadline, leader_outcomes))
+        leader.start()
+        self.leading.wait()
+        follower = threading.Thread(target=self.call,
+                                    args=(follower_deadline,
+                                          follower_outcomes))
+        follower.start()
+        while not self.single_flight.coalesced:  # Wait for it to join.
+            time.sleep(0.01)
+        self.release.set()
+        leader.join()
+        follower.join()
+        self.assertIsInstance(leader_outcomes[0], Timeout)
+        return follower_outcomes[0]
+
+    def test_later_deadline_retries(self):
+        leader_deadline = utils.deadline_in(1)
+        follower_deadline = utils.deadline_in(60)
+        outcome = self.run_follower(leader_deadline, follower_deadline)
+        self.assertEqual(outcome, 'result')
+        self.assertEqual(self.deadlines, [leader_deadline, follower_deadline])
+        # The retry isn't counted as coalesced.
+        self.assertEqual(self.single_flight.stats,
+                         {'calls': 2, 'coalesced': 0})
+
+    def test_no_deadline_retries(self):
+        outcome = self.run_follower(utils.deadline_in(1), None)
+        self.assertEqual(outcome, 'result')
+
+    def test_earlier_deadline_shares_timeout(self):
+        leader_deadline = utils.deadline_in(60)
+        outcome = self.run_follower(leader_deadline, utils.deadline_in(1))
+        self.assertIsInstance(outcome, Timeout)
+        self.assertEqual(self.deadlines, [leader_deadline])
+
+
+if __name__ == '__main__':
+    unittest.main()
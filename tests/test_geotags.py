@@ -0,0 +1,82 @@
+import functools
+import os
+import threading
+import unittest
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from unittest import mock
+
+# Importing the package fetches the list of Craigslist sites, which isn't
+# needed (nor wanted) here.
+with mock.patch('requests.get') as requests_get:
+    requests_get.return_value.content = b''
+    from craigslist.geotags import GeotagProvider
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+SEARCH_URL = 'http://sfbay.craigslist.org/search/sfc/roo'
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class GeotagProviderTest(unittest.TestCase):
+    """ Runs against a local server serving recorded map search responses. """
+
+    @classmethod
+    def setUpClass(cls):
+        handler = functools.partial(QuietHandler, directory=FIXTURES_DIR)
+        cls.server = HTTPServer(('127.0.0.1', 0), handler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def fixture_url(self, name):
+        return 'http://127.0.0.1:%s/%s' % (self.server.server_port, name)
+
+    def test_search_url(self):
+        self.assertEqual(GeotagProvider.search_url(SEARCH_URL),
+                         'http://sfbay.craigslist.org/jsonsearch/sfc/roo')
+
+    def test_expands_clusters(self):
+        provider = GeotagProvider(url=self.fixture_url('jsonsearch.json'))
+        geotags = provider.get_geotags(SEARCH_URL, {'s': 100, 'query': 'x'})
+        self.assertEqual(geotags, {
+            '7001': (37.7599, -122.4148),
+            '7003': (37.7806, -122.4055),
+            '7004': (37.7821, -122.4011),
+        })
+
+    def test_missing_ids(self):
+        provider = GeotagProvider(url=self.fixture_url('jsonsearch.json'))
+        geotags = provider.get_geotags(SEARCH_URL)
+        self.assertNotIn('7002', geotags)  # No coordinates
+        self.assertNotIn('9999', geotags)  # Not in the response
+
+    def test_cached(self):
+        provider = GeotagProvider(url=self.fixture_url('jsonsearch.json'))
+        geotags = provider.get_geotags(SEARCH_URL)
+        # Same key (url and filters other than 's'), so it's not fetched.
+        with mock.patch.object(provider, '_fetch') as fetch:
+            self.assertEqual(provider.get_geotags(SEARCH_URL, {'s': 200}),
+                             geotags)
+            self.assertFalse(fetch.called)
+
+    def test_malformed_response(self):
+        provider = GeotagProvider(url=self.fixture_url('error.json'))
+        self.assertEqual(provider.get_geotags(SEARCH_URL), {})
+        self.assertEqual(provider._cache, {})  # Failures aren't cached
+
+    def test_failed_request(self):
+        provider = GeotagProvider(url=self.fixture_url('missing.json'))
+        self.assertEqual(provider.get_geotags(SEARCH_URL), {})
+        self.assertEqual(provider._cache, {})
+
+
+if __name__ == '__main__':
+    unittest.main()